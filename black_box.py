@@ -36,7 +36,9 @@ class FeedForwardNN(nn.Module):
         out_dim = np.prod(out_shape)
         
         self.in_layer = nn.Linear(in_dim, hidden_shape[0])
-        self.hidden_layers = []
+        # The hidden layers are kept in a ModuleList so that they're registered as submodules,
+        # which makes them trainable and moves them along with the rest of the network
+        self.hidden_layers = nn.ModuleList()
         for dim in range(len(hidden_shape)-1):
             self.hidden_layers.append(nn.Linear(hidden_shape[dim], hidden_shape[dim+1]))
         self.out_layer = nn.Linear(hidden_shape[-1], out_dim)
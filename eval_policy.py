@@ -47,7 +47,7 @@ def rollout(policy, env, ep, render):
     """
     # Rollout for ep episodes
     for _ in range(ep):
-        obs = env.reset()[0]
+        obs, _ = env.reset()
         done = False
 
         # number of timesteps so far
@@ -6,19 +6,106 @@
 
 import gymnasium as gym
 import time
+from functools import partial
 import wandb
 
 import numpy as np
 import torch
-import torch.nn as nn
+import torch.nn.functional as F
 from torch.optim import Adam
 from torch.optim.lr_scheduler import ExponentialLR
-from torch.distributions import MultivariateNormal, Categorical
+from torch.distributions import Normal, Independent, Categorical
 
 from matplotlib import pyplot as plt
 
 from rnd import RND
 
+def _make_env(spec, max_timesteps_per_episode):
+    """
+        Create a copy of an environment to be stepped in a subprocess of a vector environment.
+        Parameters:
+            spec - the spec of the environment to copy
+            max_timesteps_per_episode - the maximum number of timesteps per episode
+        Return:
+            env - the new environment
+    """
+    return gym.wrappers.TimeLimit(gym.make(spec), max_timesteps_per_episode)
+
+def _ppo_losses(V, returns, curr_log_probs, batch_log_probs, A_k, clip_lo: float, clip_hi: float):
+    """
+        Calculate the actor and critic losses of one PPO update. This is kept as a standalone
+        function so that it can be compiled into a single fused graph by torch.compile, or
+        scripted with torch.jit so that its elementwise ops are fused otherwise.
+        Parameters:
+            V - the values of the batch observations predicted by the current critic
+            returns - the returns of the batch, used as the targets of the critic
+            curr_log_probs - the log probabilities of the batch actions under the current actor
+            batch_log_probs - the log probabilities of the batch actions under the actor at rollout time
+            A_k - the normalized advantages of the batch
+            clip_lo, clip_hi - the bounds to clip the ratio to
+        Return:
+            actor_loss - the clipped surrogate loss of the actor
+            critic_loss - the loss of the critic
+    """
+    # Calculate the ratio pi_theta(a_t | s_t) / pi_theta_k(a_t | s_t)
+    ratios = torch.exp(curr_log_probs - batch_log_probs)
+
+    # Calculate surrogate losses.
+    surr1 = ratios * A_k
+    surr2 = torch.clamp(ratios, clip_lo, clip_hi) * A_k
+
+    # Calculate actor and critic losses.
+    # NOTE: we take the negative min of the surrogate losses because we're trying to maximize
+    # the performance function, but Adam minimizes the loss. So minimizing the negative
+    # performance function maximizes it.
+    actor_loss = (-torch.min(surr1, surr2)).mean()
+    critic_loss = F.mse_loss(V, returns)
+
+    return actor_loss, critic_loss
+
+@torch.jit.script
+def _fast_vec_gae(rews, values, values_next, dones, gamma: float, lambda_return: float):
+    """
+        Run the reverse recurrence of Generalized Advantage Estimation over a batch of episodes.
+        The recurrence is scripted so that the loop over timesteps runs without the Python interpreter.
+        Parameters:
+            rews - the rewards, Shape: (number of episodes, number of timesteps)
+            values - the value function estimates, Shape: (number of episodes, number of timesteps)
+            values_next - the value function estimates of the next timesteps, Shape: (number of episodes, number of timesteps)
+            dones - 1 where the value of the next timestep isn't bootstrapped and the recurrence is cut, 0 otherwise, Shape: (number of episodes, number of timesteps)
+            gamma - the discount factor
+            lambda_return - the smoothing factor of GAE
+        Return:
+            advantages - the estimated advantages, Shape: (number of episodes, number of timesteps)
+    """
+    not_dones = 1.0 - dones
+
+    # Calculate the TD errors of all timesteps at once
+    deltas = rews + gamma * values_next * not_dones - values
+
+    # Accumulate the discounted sum of the TD errors from the end of the episodes
+    advantages = torch.empty_like(deltas)
+    discounted_estimate = torch.zeros_like(deltas[:, 0])
+    for t in range(deltas.size(1) - 1, -1, -1):
+        discounted_estimate = deltas[:, t] + gamma * lambda_return * not_dones[:, t] * discounted_estimate
+        advantages[:, t] = discounted_estimate
+
+    return advantages
+
+@torch.jit.script
+def _whiten(x, eps: float):
+    """
+        Normalize a tensor to zero mean and unit variance. The mean and variance are calculated
+        in a single pass, and the normalization is scripted so that it runs as one fused op.
+        Parameters:
+            x - the tensor to normalize
+            eps - a small number added to the variance to avoid dividing by 0
+        Return:
+            x - the normalized tensor
+    """
+    var, mean = torch.var_mean(x)
+    return (x - mean) * torch.rsqrt(var + eps)
+
 class PPO:
     """
         This is the PPO class we will use as our model in main.py
@@ -46,6 +133,18 @@ class PPO:
         self.env = env
         self.obs_shape = env.observation_space.shape
 
+        # Create the environments to collect rollouts from in parallel. A single environment is
+        # stepped in this process, more are copied from the spec of env and run in subprocesses.
+        # The copies are made with gym.make, so any wrappers put on env by hand are not applied to them.
+        # The environments reset themselves in the same step an episode ends.
+        if self.num_envs == 1:
+            env_fns = [lambda: gym.wrappers.TimeLimit(env, self.max_timesteps_per_episode)]
+            self.envs = gym.vector.SyncVectorEnv(env_fns, autoreset_mode=gym.vector.AutoresetMode.SAME_STEP)
+        else:
+            assert env.spec is not None, "num_envs > 1 needs an environment created with gym.make, so that it can be copied from its spec"
+            env_fns = [partial(_make_env, env.spec, self.max_timesteps_per_episode)] * self.num_envs
+            self.envs = gym.vector.AsyncVectorEnv(env_fns, autoreset_mode=gym.vector.AutoresetMode.SAME_STEP)
+
         if type(env.action_space) == gym.spaces.Box:
             self.act_type = 'box'
             self.act_shape = env.action_space.shape
@@ -59,6 +158,24 @@ class PPO:
         self.actor = actor                                                                                      # ALG STEP 1
         self.critic = critic
 
+        # Train on the GPU if there is one. Rollouts stay on the CPU with the environment.
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.actor.to(self.device)
+        self.critic.to(self.device)
+
+        # The bounds to clip the ratio to in the surrogate loss, fixed for the whole training
+        self._clip_lo, self._clip_hi = 1 - self.clip, 1 + self.clip
+
+        # Compile the networks and the loss calculation to fuse their ops in the update loop.
+        # The modules are compiled in place so that their state dicts stay loadable without PPO.
+        # Without torch.compile, the loss calculation is still scripted to fuse its ops.
+        if self.use_torch_compile:
+            self.actor.compile(mode="reduce-overhead")
+            self.critic.compile(mode="reduce-overhead")
+            self._ppo_losses = torch.compile(_ppo_losses)
+        else:
+            self._ppo_losses = torch.jit.script(_ppo_losses)
+
         # Initialize optimizers for actor and critic
         self.actor_optim = Adam(self.actor.parameters(), lr=self.lr, eps=1e-5)
         self.critic_optim = Adam(self.critic.parameters(), lr=self.lr, eps=1e-5)
@@ -68,9 +185,35 @@ class PPO:
         self.critic_scheduler = ExponentialLR(self.critic_optim, gamma=self.annealing_rate)
         
         if self.act_type == 'box':
-            # Initialize the covariance matrix used to query the actor for actions
-            self.cov_var = torch.full(size=self.act_shape, fill_value=0.5)
-            self.cov_mat = torch.diag(self.cov_var)
+            # Initialize the diagonal of the covariance matrix used to query the actor for actions.
+            # Since the covariance is diagonal, the distribution factors into independent normals
+            # with standard deviations cov_std, which avoids the Cholesky solves of a full covariance.
+            # cov_std is fixed and valid, so the distributions skip validating their arguments.
+            self.cov_var = torch.full(size=self.act_shape, fill_value=0.5, device=self.device)
+            self.cov_std = self.cov_var.sqrt()
+
+        # Discrete actions are stored as the index of the action taken
+        act_shape = self.act_shape if self.act_type == 'box' else ()
+
+        # Every environment runs for the same number of timesteps per rollout, enough to fill the batch
+        self._n_steps = -(-self.timesteps_per_batch // self.num_envs)
+
+        # Rollout data, indexed by (timestep, environment). The buffers are allocated once and reused
+        # by every rollout, which copies the batch out of them. The actions and log probabilities
+        # come from the actor, so they are kept as tensors on its device.
+        self._obs_buf = np.empty((self._n_steps, self.num_envs, *self.obs_shape), dtype=np.float32)
+        self._act_buf = torch.empty((self._n_steps, self.num_envs, *act_shape), device=self.device)
+        self._log_prob_buf = torch.empty((self._n_steps, self.num_envs), device=self.device)
+        self._extr_rew_buf = np.empty((self._n_steps, self.num_envs), dtype=np.float32)
+        self._next_obs_buf = np.empty((self._n_steps, self.num_envs, *self.obs_shape), dtype=np.float32)
+
+        # The environments are reset once, on the first rollout, and every rollout continues the episodes
+        # the previous one left running. _obs holds the observations the environments are at, and the
+        # lengths and returns of the running episodes are accumulated across rollouts to log whole episodes.
+        self._obs = None
+        self._ep_lens = np.zeros(self.num_envs, dtype=np.int64)
+        self._ep_extr_rets = np.zeros(self.num_envs)
+        self._ep_intr_rets = np.zeros(self.num_envs)
         
         # This logger will help us with printing out summaries of each iteration
         self.logger = {
@@ -79,15 +222,19 @@ class PPO:
             'i_so_far': 0,          # iterations so far
             'batch_lens': [],       # episodic lengths in batch
             'batch_rews': [],       # episodic returns in batch
+            'batch_extr_rews': [],  # episodic extrinsic returns in batch
+            'batch_intr_rews': [],  # episodic intrinsic returns in batch
             'actor_losses': [],     # losses of actor network in current iteration
         }
         
-        # Walk a random agent through the environment to initialize the RND networks
-        ex_f = self.exploration_factor
-        self.exploration_factor = 0
-        batch_obs, _, _, _, _, _ = self.rollout()
-        self.rnd = RND(self.obs_shape, batch_obs.numpy())
-        self.exploration_factor = ex_f
+        # Initialize the RND networks. Their variance estimators are initialized with the
+        # observations of the first rollout, so no extra rollout is spent on it.
+        self.rnd = RND(self.obs_shape, use_torch_compile=self.use_torch_compile)
+
+        # The figure the observations are plotted on is created once and redrawn every time
+        if self.debug_plot:
+            self._fig, self._ax = plt.subplots()
+            plt.show(block=False)
 
     def learn(self, total_timesteps):
         """
@@ -103,7 +250,8 @@ class PPO:
         i_so_far = 0 # Iterations ran so far
         while t_so_far < total_timesteps:                                                                       # ALG STEP 2
             # Autobots, roll out (just kidding, we're collecting our batch simulations here)
-            batch_obs, batch_acts, batch_log_probs, batch_intr_rews, batch_extr_rews, batch_lens = self.rollout()    # ALG STEP 3
+            batch_obs, batch_acts, batch_log_probs, batch_intr_rews, batch_extr_rews, batch_lens, \
+                batch_next_obs, batch_terminals = self.rollout()                                                # ALG STEP 3
 
             # Calculate how many timesteps we collected this batch
             t_so_far += np.sum(batch_lens)
@@ -115,48 +263,53 @@ class PPO:
             self.logger['t_so_far'] = t_so_far
             self.logger['i_so_far'] = i_so_far
 
-            # Calculate advantage at k-th iteration using GAE
-            V, _ = self.evaluate(batch_obs, batch_acts)
+            # Calculate advantage at k-th iteration using GAE. Only the critic is needed for the
+            # values of the old policy, so the actor is not run here. The values of the observations
+            # and of the observations the actions led to are estimated in a single pass, whose shape
+            # is the same every iteration, so a compiled critic isn't recompiled or re-recorded for it.
+            V_old, V_next = self._values(torch.cat([batch_obs, batch_next_obs])).chunk(2)
             batch_rews = batch_extr_rews + self.exploration_factor*batch_intr_rews
-            A_k = self.estimate_advantage(batch_rews, V.detach())
+            A_k = self.estimate_advantage(batch_rews, V_old, V_next, batch_terminals, batch_lens)
+
+            # The targets of the critic are the returns R_t = A_t + V_old(s_t). They are fixed for
+            # the whole iteration, so they're calculated once from the unnormalized advantages.
+            returns = A_k + V_old
 
             # One of the only tricks I use that isn't in the pseudocode. Normalizing advantages
             # isn't theoretically necessary, but in practice it decreases the variance of 
             # our advantages and makes convergence much more stable and faster. I added this because
             # solving some environments was too unstable without it.
-            A_k = (A_k - A_k.mean()) / (A_k.std() + 1e-10)
+            A_k = _whiten(A_k, 1e-10)
 
             # This is the loop where we update our network for some n epochs
             for _ in range(self.n_updates_per_iteration):                                                       # ALG STEP 6 & 7
-                # Calculate V_phi and pi_theta(a_t | s_t)
-                V, curr_log_probs = self.evaluate(batch_obs, batch_acts)
-
-                # Calculate the ratio pi_theta(a_t | s_t) / pi_theta_k(a_t | s_t)
-                ratios = torch.exp(curr_log_probs - batch_log_probs)
-
-                # Calculate surrogate losses.
-                surr1 = ratios * A_k
-                surr2 = torch.clamp(ratios, 1 - self.clip, 1 + self.clip) * A_k
-
-                # Calculate actor and critic losses.
-                # NOTE: we take the negative min of the surrogate losses because we're trying to maximize
-                # the performance function, but Adam minimizes the loss. So minimizing the negative
-                # performance function maximizes it.
-                actor_loss = (-torch.min(surr1, surr2)).mean()
-                critic_loss = nn.MSELoss()(V, A_k + V)
-
-                # Calculate gradients and perform backward propagation for actor network
-                self.actor_optim.zero_grad()
-                actor_loss.backward(retain_graph=True)
-                self.actor_optim.step()
-
-                # Calculate gradients and perform backward propagation for critic network
-                self.critic_optim.zero_grad()
-                critic_loss.backward()
-                self.critic_optim.step()
-                
-                # Log actor loss
-                self.logger['actor_losses'].append(actor_loss.detach())
+                # Shuffle the batch, and update the networks on one minibatch of it at a time
+                batch_idx = torch.randperm(len(batch_obs), device=self.device)
+                for start in range(0, len(batch_obs), self.minibatch_size):
+                    mb_idx = batch_idx[start:start + self.minibatch_size]
+
+                    # Run the forward passes in bfloat16 if mixed precision is on. bfloat16 has the range
+                    # of float32, so the gradients don't need to be scaled.
+                    with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+                        # Calculate V_phi and pi_theta(a_t | s_t)
+                        V, curr_log_probs = self.evaluate(batch_obs[mb_idx], batch_acts[mb_idx])
+
+                        # Calculate actor and critic losses.
+                        actor_loss, critic_loss = self._ppo_losses(V, returns[mb_idx], curr_log_probs, batch_log_probs[mb_idx],
+                                                                   A_k[mb_idx], self._clip_lo, self._clip_hi)
+
+                    # Calculate gradients for actor and critic networks. The networks share no parameters,
+                    # so a single backward pass of the summed losses gives each one its own gradients.
+                    self.actor_optim.zero_grad(set_to_none=True)
+                    self.critic_optim.zero_grad(set_to_none=True)
+                    (actor_loss + critic_loss).backward()
+
+                    # Perform backward propagation for actor and critic networks
+                    self.actor_optim.step()
+                    self.critic_optim.step()
+
+                    # Log actor loss
+                    self.logger['actor_losses'].append(actor_loss.detach())
                         
             # Anneal the learning rate
             self.actor_scheduler.step()
@@ -166,19 +319,28 @@ class PPO:
             # Print a summary of our training so far
             self._log_summary()
 
-            plt.scatter(np.transpose(batch_obs)[0].numpy(), np.transpose(batch_obs)[1].numpy())
-            plt.show()
+            # Plot the first two dimensions of the observations in this batch without blocking training
+            if self.debug_plot and i_so_far % self.render_every_i == 0:
+                self._ax.clear()
+                self._ax.scatter(batch_obs[:, 0].cpu().numpy(), batch_obs[:, 1].cpu().numpy())
+                self._fig.canvas.draw_idle()
+                self._fig.canvas.flush_events()
 
             # Save our model if it's time
             if i_so_far % self.save_freq == 0:
                 torch.save(self.actor.state_dict(), './ppo_actor.pth')
                 torch.save(self.critic.state_dict(), './ppo_critic.pth')
 
+        # Close the environments, which also stops the subprocesses of parallel environments
+        self.envs.close()
+
     def rollout(self):
         """
             Too many transformers references, I'm sorry. This is where we collect the batch of data
             from simulation. Since this is an on-policy algorithm, we'll need to collect a fresh batch
             of data each time we iterate the actor/critic networks.
+            The num_envs environments are stepped in parallel, and the timesteps of each episode
+            are gathered next to each other in the returned batch.
             Parameters:
                 None
             Return:
@@ -186,143 +348,175 @@ class PPO:
                 batch_acts - the actions collected this batch. Shape: (number of timesteps, dimension of action)
                 batch_log_probs - the log probabilities of each action taken this batch. Shape: (number of timesteps)
                 batch_intr_rews - the intrinsic rewards of each timestep in this batch. Shape: (number of timesteps)
-                batch_extr_rews - the extrinsic rewards of each timestep in this batch. Shape: (number of episodes)
-                batch_lens - the lengths of each episode this batch. Shape: (number of episodes)
+                batch_extr_rews - the extrinsic rewards of each timestep in this batch. Shape: (number of timesteps)
+                batch_lens - the number of timesteps of each episode in this batch, which can have started in an earlier one. Shape: (number of episodes)
+                batch_next_obs - the observations the actions led to this batch. Shape: (number of timesteps, dimension of observation)
+                batch_terminals - whether each episode this batch was terminated, rather than truncated or cut at the end of the batch. Shape: (number of episodes)
         """
-        # Batch data. For more details, check function header.
-        batch_obs = []
-        batch_acts = []
-        batch_log_probs = []
-        batch_intr_rews = []
-        batch_extr_rews = []
-        batch_lens = []
-
-        # Episodic data. Keeps track of rewards per episode, will get cleared
-        # upon each new episode
-        ep_intr_rews = []
-        ep_extr_rews = []
-
-        t = 0 # Keeps track of how many timesteps we've run so far this batch
-
-        # Keep simulating until we've run more than or equal to specified timesteps per batch
-        while t < self.timesteps_per_batch:
-            ep_intr_rews = [] # rewards collected per episode
-            ep_extr_rews = []
-
-            # Reset the environment. sNote that obs is short for observation. 
-            obs = self.env.reset()[0]
-            done = False
-
-            # Run an episode for a maximum of max_timesteps_per_episode timesteps
-            for ep_t in range(self.max_timesteps_per_episode):
-                # If render is specified, render the environment
-                if self.render and (self.logger['i_so_far'] % self.render_every_i == 0) and len(batch_lens) == 0:
-                    self.env.render()
-
-                t += 1 # Increment timesteps ran this batch so far
-
-                # Track observations in this batch
-                batch_obs.append(obs)
-
-                # Calculate action 
-                action, log_prob = self.get_action(obs)
-                
-                # Make a step in the env and track reward.
-                # Note that rew is short for reward.
-                obs, rew, done, _, _ = self.env.step(action)
-                ep_extr_rews.append(rew)
-                if self.exploration_factor:
-                    in_rew = self.rnd.get_reward(obs)
-                    ep_intr_rews.append(in_rew)
-                
-                # Track recent action, and action log probability
-                if self.act_type == 'discrete':
-                    action = torch.tensor(action)
-                batch_acts.append(action)
-                batch_log_probs.append(log_prob)
-
-                # If the environment tells us the episode is terminated, break
-                if done:
-                    break
-                
-            if self.exploration_factor:
-                # Reset the variance estimator in RND
-                if self.logger['i_so_far'] < self.std_set_iteration:
+        # The episodes of this batch as (environment, first timestep, last timestep + 1, terminated),
+        # and the timestep the currently running episode of each environment started at
+        episodes = []
+        ep_starts = np.zeros(self.num_envs, dtype=np.int64)
+
+        # Only render the first episode of every render_every_i iterations
+        should_render = self.render and (self.logger['i_so_far'] % self.render_every_i == 0)
+
+        # Reset the environments if they haven't been yet. Note that obs is short for observation.
+        if self._obs is None:
+            self._obs, _ = self.envs.reset()
+        obs = self._obs
+
+        for t in range(self._n_steps):
+            # If render is specified, render the environment
+            if should_render and len(episodes) == 0:
+                self.envs.render()
+
+            # Track observations in this batch
+            self._obs_buf[t] = obs
+
+            # Calculate actions for all environments at once
+            action, log_prob = self.get_action(obs)
+
+            # Make a step in the envs and track reward.
+            # Note that rew is short for reward.
+            # The environments reset themselves when an episode is done.
+            obs, rew, terminated, truncated, info = self.envs.step(action.cpu().numpy())
+            done = terminated | truncated
+            self._extr_rew_buf[t] = rew
+
+            # Track the observations the actions led to, to calculate the intrinsic rewards from.
+            # obs already holds the first observations of the next episodes of the finished
+            # environments, their last observations are kept in the info.
+            self._next_obs_buf[t] = obs
+            for i in np.flatnonzero(done):
+                self._next_obs_buf[t, i] = info['final_obs'][i]
+
+            # Track recent action, and action log probability
+            self._act_buf[t] = action
+            self._log_prob_buf[t] = log_prob
+
+            # Close the episodes the environments have finished
+            for i in np.flatnonzero(done):
+                episodes.append((i, ep_starts[i], t + 1, bool(terminated[i])))
+                ep_starts[i] = t + 1
+
+        # Keep the observations the environments are at for the next rollout
+        self._obs = obs
+
+        # Cut the episodes that are still running at the end of the batch. They go on in the next
+        # rollout, and are appended after the finished episodes, so the first n_finished episodes
+        # are the ones that finished in this batch.
+        n_finished = len(episodes)
+        for i in range(self.num_envs):
+            if ep_starts[i] < self._n_steps:
+                episodes.append((i, ep_starts[i], self._n_steps, False))
+
+        # Track episodic lengths
+        batch_lens = [int(end - start) for _, start, end, _ in episodes]
+
+        # Only terminated episodes really end. The others are bootstrapped from the value of the
+        # observation after their last timestep, which the next observations already hold.
+        batch_next_obs = np.concatenate([self._next_obs_buf[start:end, i] for i, start, end, _ in episodes])
+        batch_terminals = torch.as_tensor([terminal for _, _, _, terminal in episodes], device=self.device)
+
+        # Flatten the rewards so that they line up with the observations. The episodes
+        # can be recovered from the flat arrays with the offsets in batch_lens.
+        batch_extr_rews = np.concatenate([self._extr_rew_buf[start:end, i] for i, start, end, _ in episodes])
+        batch_intr_rews = np.zeros_like(batch_extr_rews)
+
+        if self.exploration_factor:
+            # Calculate the intrinsic rewards of the whole batch at once
+            batch_intr_rews = self.rnd.get_reward_batch(batch_next_obs)
+
+            for ep_start, ep_len in zip(np.cumsum(batch_lens) - batch_lens, batch_lens):
+                ep_intr_rews = batch_intr_rews[ep_start:ep_start + ep_len]
+
+                # Reset the variance estimator in RND. The variance of a single reward is undefined,
+                # so episodes cut down to one timestep keep the previous estimator.
+                if self.logger['i_so_far'] < self.std_set_iteration and ep_len > 1:
                     self.rnd.reset_rew_std(ep_intr_rews)
-                
+
                 # Normalize intrinsic rewards
-                ep_intr_rews = ep_intr_rews / (self.rnd.get_rew_std() + 1e-10)
-            
-            # Track episodic lengths and rewards
-            batch_lens.append(ep_t + 1)
-            batch_intr_rews.append(ep_intr_rews)
-            batch_extr_rews.append(ep_extr_rews)
+                ep_intr_rews /= self.rnd.get_rew_std() + 1e-10
 
         # Reshape data as tensors in the shape specified in function description, before returning
-        batch_obs = torch.tensor(np.array(batch_obs), dtype=torch.float)
-        batch_acts = torch.tensor(batch_acts, dtype=torch.float)
-        batch_log_probs = torch.tensor(batch_log_probs, dtype=torch.float)
-        batch_extr_rews = np.array(batch_extr_rews)
-        batch_intr_rews = np.array(batch_intr_rews)
-        if not self.exploration_factor:
-            batch_intr_rews = np.zeros_like(batch_extr_rews)
-
-        # Log the episodic returns and episodic lengths in this batch.
-        self.logger['batch_intr_rews'] = batch_intr_rews
-        self.logger['batch_extr_rews'] = batch_extr_rews
-        self.logger['batch_lens'] = batch_lens
-
-        return batch_obs, batch_acts, batch_log_probs, batch_intr_rews, batch_extr_rews, batch_lens
+        batch_obs = self._to_device(np.concatenate([self._obs_buf[start:end, i] for i, start, end, _ in episodes]))
+        batch_next_obs = self._to_device(batch_next_obs)
+        batch_acts = torch.cat([self._act_buf[start:end, i] for i, start, end, _ in episodes])
+        batch_log_probs = torch.cat([self._log_prob_buf[start:end, i] for i, start, end, _ in episodes])
+
+        # Add the timesteps of this batch to the lengths and returns of the running episodes, and log
+        # the episodes that finished in this batch. The cut episodes are logged once they finish.
+        ep_offsets = np.cumsum(batch_lens) - batch_lens
+        ep_extr_rets = np.add.reduceat(batch_extr_rews, ep_offsets)
+        ep_intr_rets = np.add.reduceat(batch_intr_rews, ep_offsets)
+        for n, (i, _, _, _) in enumerate(episodes):
+            self._ep_lens[i] += batch_lens[n]
+            self._ep_extr_rets[i] += ep_extr_rets[n]
+            self._ep_intr_rets[i] += ep_intr_rets[n]
+            if n < n_finished:
+                self.logger['batch_lens'].append(self._ep_lens[i])
+                self.logger['batch_extr_rews'].append(self._ep_extr_rets[i])
+                self.logger['batch_intr_rews'].append(self._ep_intr_rets[i])
+                self._ep_lens[i] = self._ep_extr_rets[i] = self._ep_intr_rets[i] = 0
+
+        return batch_obs, batch_acts, batch_log_probs, batch_intr_rews, batch_extr_rews, batch_lens, batch_next_obs, batch_terminals
 
     # Generalized Advantage Estimation
-    def estimate_advantage(self, batch_rews, values):
+    def estimate_advantage(self, batch_rews, values, next_values, batch_terminals, batch_lens):
         """
             Estimate the advantage at each timestep in a batch given the rewards.
             Parameters:
-                batch_rews - the rewards in a batch, Shape: (number of episodes, number of timesteps per episode)
+                batch_rews - the rewards in a batch, Shape: (number of timesteps in batch)
                 values - the value function estimates, Shape: (number of timesteps in batch)
+                next_values - the value function estimates of the observations the actions led to, Shape: (number of timesteps in batch)
+                batch_terminals - whether each episode in the batch was terminated, Shape: (number of episodes)
+                batch_lens - the lengths of each episode in the batch, Shape: (number of episodes)
             Return:
                 advantages - the estimated advantages, Shape: (number of timesteps in batch)
         """
-        # The advantages per episode per batch to return.
-        # The shape will be (num timesteps per episode)
-        advantages = []
-        
-        # Iterate through each episode
-        for ep_rews in reversed(batch_rews):
-            
-            discounted_estimate = 0
-            
-            # Iterate through all rewards in the episode.
-            for rew, v_cur, v_next in reversed(list(zip(ep_rews, values, values[1:]))):
-                delta = rew + v_next * self.gamma - v_cur
-                discounted_estimate = delta + discounted_estimate * self.gamma * self.lambda_return
-                advantages.insert(0, discounted_estimate)
-
-        # Convert the advantages into a tensor
-        advantages = torch.tensor(advantages, dtype=torch.float)
+        # Lay the episodes out as the rows of a (number of episodes, longest episode) matrix,
+        # padding the ends of the shorter episodes with zeros
+        ep_lens = torch.as_tensor(batch_lens, device=values.device)
+        timesteps = torch.arange(max(batch_lens), device=values.device)
+        valid = timesteps < ep_lens.unsqueeze(1)
+
+        rews = values.new_zeros(valid.shape)
+        rews[valid] = torch.as_tensor(batch_rews, dtype=torch.float, device=values.device)
+        ep_values = values.new_zeros(valid.shape)
+        ep_values[valid] = values
+
+        # The value of the state after the last timestep of an episode is taken to be 0 if the episode
+        # was terminated. Episodes that were truncated or cut at the end of the batch are bootstrapped
+        # from the value of the observation they were cut at.
+        ep_values_next = torch.cat([ep_values[:, 1:], values.new_zeros(len(batch_lens), 1)], dim=1)
+        last_values = next_values[torch.cumsum(ep_lens, 0) - 1]
+        ep_values_next[torch.arange(len(batch_lens), device=values.device), ep_lens - 1] = last_values.masked_fill(batch_terminals, 0)
+
+        # Only the padding is done, so that the value after the last timestep is kept in the TD error
+        dones = (timesteps >= ep_lens.unsqueeze(1)).float()
+
+        # Run the recurrence of all episodes at once, and drop the padding
+        advantages = _fast_vec_gae(rews, ep_values, ep_values_next, dones, self.gamma, self.lambda_return)
+        advantages = advantages[valid]
 
         return advantages
         
+    @torch.inference_mode()
     def get_action(self, obs):
         """
-            Queries an action from the actor network, should be called from rollout.
+            Queries an action for every environment from the actor network, should be called from rollout.
+            No gradients are needed to act, so this runs in inference mode without autograd bookkeeping.
             Parameters:
-                obs - the observation at the current timestep
+                obs - the observations of the environments at the current timestep. Shape: (num_envs, dimension of observation)
             Return:
-                action - the action to take, as a numpy array
-                log_prob - the log probability of the selected action in the distribution
+                action - the actions to take, as a tensor. Shape: (num_envs, dimension of action)
+                log_prob - the log probabilities of the selected actions in the distribution. Shape: (num_envs)
         """
         # Query the actor network for a mean action
+        obs = torch.as_tensor(obs, dtype=torch.float, device=self.device)
         out = self.actor(obs)
-        
-        if self.act_type == 'box':
-            # Create a distribution with the mean action and std from the covariance matrix above.
-            dist = MultivariateNormal(out, self.cov_mat)
-
-        if self.act_type == 'discrete':
-            # Create a distribution from the softmax vector the actor returned
-            dist = Categorical(out)
+        dist = self._action_dist(out)
         
         # Sample an action from the distribution
         action = dist.sample()
@@ -331,7 +525,7 @@ class PPO:
         log_prob = dist.log_prob(action)
 
         # Return the sampled action and the log probability of that action in our distribution
-        return action.detach().numpy(), log_prob.detach()
+        return action, log_prob
 
     def evaluate(self, batch_obs, batch_acts):
         """
@@ -348,21 +542,64 @@ class PPO:
                 log_probs - the log probabilities of the actions taken in batch_acts given batch_obs
         """
         # Query critic network for a value V for each batch_obs. Shape of V should be same as batch_rews
-        V = self.critic(batch_obs).squeeze()
+        # The outputs of the networks are cast to float32 so that the losses are computed in full precision
+        # when running under autocast.
+        V = self.critic(batch_obs).squeeze(-1).float()
 
         # Calculate the log probabilities of batch actions using most recent actor network.
         # This segment of code is similar to that in get_action()
-        out = self.actor(batch_obs)
-        if self.act_type == 'box':
-            dist = MultivariateNormal(out, self.cov_mat)
-        if self.act_type == 'discrete':
-            dist = Categorical(out)
+        out = self.actor(batch_obs).float()
+        dist = self._action_dist(out)
         log_probs = dist.log_prob(batch_acts)
 
         # Return the value vector V of each observation in the batch
         # and log probabilities log_probs of each action in the batch
         return V, log_probs
     
+    def _action_dist(self, out):
+        """
+            Create the distribution of actions from the output of the actor network.
+            Parameters:
+                out - the output of the actor network
+            Return:
+                dist - the distribution to sample actions from and evaluate their log probabilities with
+        """
+        if self.act_type == 'box':
+            # Create a distribution with the mean action and std from the covariance matrix above.
+            return Independent(Normal(out, self.cov_std, validate_args=False), 1, validate_args=False)
+
+        if self.act_type == 'discrete':
+            # Create a distribution from the softmax vector the actor returned
+            return Categorical(out)
+
+    @torch.no_grad()
+    def _values(self, obs):
+        """
+            Estimate the values of observations with the critic alone, without tracking gradients.
+            Parameters:
+                obs - the observations as a tensor. Shape: (number of observations, dimension of observation)
+            Return:
+                V - the predicted values of obs. Shape: (number of observations)
+        """
+        return self.critic(obs).squeeze(-1)
+
+    def _to_device(self, array):
+        """
+            Move a batch of rollout data to the device the networks are trained on.
+            Parameters:
+                array - the numpy array to move
+            Return:
+                tensor - the data as a tensor on self.device
+        """
+        # torch.from_numpy shares memory with the array, so the data isn't copied on the CPU
+        tensor = torch.from_numpy(array)
+
+        # Pinned memory lets the copy to the GPU run asynchronously
+        if self.device.type == 'cuda':
+            tensor = tensor.pin_memory()
+
+        return tensor.to(self.device, non_blocking=True)
+
     def _init_hyperparameters(self, hyperparameters):
         """
             Initialize default and custom values for hyperparameters
@@ -377,6 +614,7 @@ class PPO:
         self.timesteps_per_batch = 4800                 # Number of timesteps to run per batch
         self.max_timesteps_per_episode = 1600           # Max number of timesteps per episode
         self.n_updates_per_iteration = 5                # Number of times to update actor/critic per iteration
+        self.minibatch_size = 256                       # Number of timesteps in each minibatch the batch is split into during an update
         self.lr = 0.005                                 # Learning rate of actor optimizer
         self.gamma = 0.95                               # Discount factor to be applied when calculating Rewards-To-Go
         self.lambda_return = 0.96                       # Smoothing factor to be applied in GAE. lambda=1 is equivalent to Monte Carlo
@@ -384,16 +622,20 @@ class PPO:
         self.annealing_rate = 0.995                     # Rate at which the learning rate drops to 0 with time
         self.exploration_factor = 1                     # This is beta from r = r_e + beta * r_i. If beta=0 curiosity is off.
         self.std_set_iteration = 3                      # The number of iterations until we think the ICM overfits, and the reward variance becomes stable.
+        self.num_envs = 1                               # Number of environments to collect rollouts from in parallel. More than 1 copies env from its spec, without its wrappers
         
         # Miscellaneous parameters
         self.render = True                              # If we should render during rollout
         self.render_every_i = 10                        # Only render every n iterations
+        self.debug_plot = False                         # If we should plot the observations of the batch every render_every_i iterations
         self.save_freq = 10                             # How often we save in number of iterations
         self.seed = None                                # Sets the seed of our program, used for reproducibility of results
+        self.use_torch_compile = False                  # If we should compile the actor, critic, losses and RND networks with torch.compile
+        self.use_amp = False                            # If we should run the update forward passes in bfloat16 mixed precision
 
         # Change any default values to custom values for specified hyperparameters
         for param, val in hyperparameters.items():
-            exec('self.' + param + ' = ' + str(val))
+            setattr(self, param, val)
 
         # Sets the seed if specified
         if self.seed != None:
@@ -422,10 +664,14 @@ class PPO:
 
         t_so_far = self.logger['t_so_far']
         i_so_far = self.logger['i_so_far']
-        avg_ep_lens = np.mean(self.logger['batch_lens'])
-        avg_ep_extr_rews = np.mean([np.sum(ep_extr_rews) for ep_extr_rews in self.logger['batch_extr_rews']])
-        avg_ep_intr_rews = np.mean([np.sum(ep_intr_rews) for ep_intr_rews in self.logger['batch_intr_rews']])
-        avg_actor_loss = np.mean([losses.float().mean() for losses in self.logger['actor_losses']])
+        if self.logger['batch_lens']:
+            avg_ep_lens = np.mean(self.logger['batch_lens'])
+            avg_ep_extr_rews = np.mean(self.logger['batch_extr_rews'])
+            avg_ep_intr_rews = np.mean(self.logger['batch_intr_rews'])
+        else:
+            # No episode finished in this batch
+            avg_ep_lens = avg_ep_extr_rews = avg_ep_intr_rews = float('nan')
+        avg_actor_loss = torch.stack(self.logger['actor_losses']).float().mean().item()
         lr = self.actor_scheduler.get_last_lr()[0]
 
         # Log the data in W&B
@@ -453,4 +699,6 @@ class PPO:
         # Reset batch-specific logging data
         self.logger['batch_lens'] = []
         self.logger['batch_rews'] = []
+        self.logger['batch_extr_rews'] = []
+        self.logger['batch_intr_rews'] = []
         self.logger['actor_losses'] = []
@@ -1,4 +1,4 @@
-from torch import nn
+import torch
 from torch.optim import Adam
 from black_box import FeedForwardNN
 import numpy as np
@@ -13,45 +13,76 @@ class RND:
         The error of prediction is used as a dense intrinsic reward 
         for an RL agent to augment the sparse extrinsic reward.
     """
-    def __init__(self, in_shape, init_obs):
+    def __init__(self, in_shape, use_torch_compile=False):
         '''
+            The variance estimators are initialized with the first observations the RND is given.
             Parameters:
                 in_shape - The shape of an observation
-                init_obs - A bunch of observations gathered by running a random agent in the environment to initialize the variance estimator
+                use_torch_compile - If the networks should be compiled with torch.compile
         '''
         self.lr = 1e-4
         self.target = FeedForwardNN(in_shape,  (32,), (32,32,32))
         self.predictor = FeedForwardNN(in_shape, (32,), (32,32))
+
+        # The target network is never trained, so it's frozen and always run without gradients
+        self.target.eval()
+        self.target.requires_grad_(False)
+        if use_torch_compile:
+            self.target.compile(mode="reduce-overhead")
+            self.predictor.compile(mode="reduce-overhead")
         self.predictor_optim = Adam(self.predictor.parameters(), lr=self.lr)
         self.scheduler = ExponentialLR(self.predictor_optim, 0.999)
-        self.obs_w = WelfordVarianceEstimator(init_obs)
-        init_loss = []
-        for obs in init_obs:
-            targ = self.target(obs)
-            pred = self.predictor(obs)
-            loss = nn.MSELoss()(targ, pred)
-            init_loss.append(loss.detach().numpy())
-        self.loss_w = WelfordVarianceEstimator(init_loss)
+        self.obs_w = None
+        self.loss_w = None
+
+    def update_variance(self, obs):
+        '''
+            Collects the stats of a batch of observations, which are used to normalize them.
+            The variance estimator is created from the first batch it's given.
+            Parameters:
+                obs - The observations, Shape: (number of observations, *in_shape)
+        '''
+        if self.obs_w is None:
+            self.obs_w = WelfordVarianceEstimator(obs)
+        else:
+            self.obs_w.step_batch(obs)
         
-    def get_reward(self, obs):     
-        # Normalize the observation and collect the stats
-        self.obs_w.step(obs)
+    def get_reward_batch(self, obs):
+        '''
+            Calculates the intrinsic rewards of a batch of observations with a single
+            forward and backward pass through the networks.
+            Parameters:
+                obs - The observations, Shape: (number of observations, *in_shape)
+            Return:
+                The intrinsic rewards, Shape: (number of observations)
+        '''
+        # The variance estimators are initialized with the first batch, which needs at least two observations
+        assert self.obs_w is not None or len(obs) > 1, "RND needs at least two observations to initialize its stats"
+
+        # Normalize the observations and collect the stats
+        self.update_variance(obs)
         obs = (obs-self.obs_w.get_mean())/(self.obs_w.get_variance()**0.5 + 1e-10)
-        
-        # Get the loss
-        targ = self.target(obs)
+        obs = torch.as_tensor(obs, dtype=torch.float)
+
+        # Get the loss of every observation
+        with torch.no_grad():
+            targ = self.target(obs)
         pred = self.predictor(obs)
-        loss = nn.MSELoss()(targ, pred)
-        
+        losses = ((targ - pred)**2).mean(dim=-1)
+
         # Learn
-        self.predictor_optim.zero_grad()
-        loss.backward()
+        self.predictor_optim.zero_grad(set_to_none=True)
+        losses.mean().backward()
         self.predictor_optim.step()
-        
-        # Collect the stats        
-        self.loss_w.step(loss.detach().numpy())
 
-        return loss.detach().numpy()
+        # Collect the stats
+        losses = losses.detach().numpy()
+        if self.loss_w is None:
+            self.reset_rew_std(losses)
+        else:
+            self.loss_w.step_batch(losses)
+
+        return losses
 
     def anneal_lr(self):
         self.scheduler.step()
@@ -1,3 +1,5 @@
+import numpy as np
+
 class WelfordVarianceEstimator:
     '''
         This class implements a version of Welford's algorithm 
@@ -13,8 +15,8 @@ class WelfordVarianceEstimator:
         self.M_k = init_x[0]
         self.S_k = 0
         self.k = 1
-        for x in init_x[1:]:
-            self.step(x)
+        if len(init_x) > 1:
+            self.step_batch(init_x[1:])
             
     def step(self, x):
         self.k += 1
@@ -22,6 +24,22 @@ class WelfordVarianceEstimator:
         self.S_k = self.S_k + (x-self.M_k)*(x-M_k1)
         self.M_k = M_k1
 
+    def step_batch(self, xs):
+        '''
+            Add a whole batch of data at once, by merging its mean and
+            sum of squared differences into the running ones
+            Parameters:
+                xs - The array of new data
+        '''
+        n = len(xs)
+        mean = np.mean(xs, axis=0)
+        S = np.sum((xs-mean)**2, axis=0)
+        delta = mean-self.M_k
+        k = self.k + n
+        self.M_k = self.M_k + delta*n/k
+        self.S_k = self.S_k + S + delta**2*self.k*n/k
+        self.k = k
+
     def get_variance(self):
         if self.k < 2:
             print("Cannot calculate variance of a two element list")